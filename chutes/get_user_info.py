@@ -23,6 +23,23 @@ sys.path.insert(0, str(Path(__file__).parent / "chutes"))
 from chutes.util.auth import get_signing_message
 from chutes.constants import HOTKEY_HEADER, NONCE_HEADER, SIGNATURE_HEADER
 
+def signed_headers(keypair, purpose):
+    """Build auth headers with a fresh nonce and a signature for the given purpose"""
+    nonce = str(int(time.time()))
+    sig_str = get_signing_message(HOTKEY_SS58, nonce, payload_str=None, purpose=purpose)
+    return {
+        HOTKEY_HEADER: HOTKEY_SS58,
+        NONCE_HEADER: nonce,
+        SIGNATURE_HEADER: keypair.sign(sig_str.encode()).hex(),
+    }
+
+async def fetch(session, path, headers):
+    """GET an endpoint and return (status, response headers, JSON data or error text)"""
+    async with session.get(path, headers=headers, params={"limit": "1"}) as resp:
+        if resp.status == 200:
+            return resp.status, dict(resp.headers), await resp.json()
+        return resp.status, dict(resp.headers), await resp.text()
+
 async def get_user_info():
     """Try to get user info using various endpoints"""
     
@@ -33,64 +50,47 @@ async def get_user_info():
     print(f"Attempting to get user info for username: {USERNAME}")
     
     async with aiohttp.ClientSession(base_url=API_BASE_URL) as session:
-        # Try listing chutes (this uses purpose-based auth)
-        nonce = str(int(time.time()))
-        headers = {
-            HOTKEY_HEADER: HOTKEY_SS58,
-            NONCE_HEADER: nonce,
-        }
-        
-        # Sign with purpose
-        sig_str = get_signing_message(HOTKEY_SS58, nonce, payload_str=None, purpose="chutes")
-        signature = keypair.sign(sig_str.encode()).hex()
-        headers[SIGNATURE_HEADER] = signature
+        # Each endpoint uses purpose-based auth, so sign each request separately
+        # and fire them concurrently over the shared connection pool
+        chutes, images, api_keys = await asyncio.gather(
+            fetch(session, "/chutes/", signed_headers(keypair, "chutes")),
+            fetch(session, "/images/", signed_headers(keypair, "images")),
+            fetch(session, "/api_keys/", signed_headers(keypair, "api_keys")),
+        )
         
         print("\n1. Trying to list chutes to find user_id...")
-        async with session.get("/chutes/", headers=headers, params={"limit": "1"}) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print(f"Success! Response headers: {dict(resp.headers)}")
-                
-                # Check if user_id is in response headers
-                for header, value in resp.headers.items():
-                    if 'user' in header.lower() and 'id' in header.lower():
-                        print(f"Found user ID in header {header}: {value}")
-                
-                # Pretty print the response to look for user_id
-                print("\nResponse data:")
-                print(json.dumps(data, indent=2))
-            else:
-                print(f"Failed: {resp.status} - {await resp.text()}")
+        status, resp_headers, data = chutes
+        if status == 200:
+            print(f"Success! Response headers: {resp_headers}")
+            
+            # Check if user_id is in response headers
+            for header, value in resp_headers.items():
+                if 'user' in header.lower() and 'id' in header.lower():
+                    print(f"Found user ID in header {header}: {value}")
+            
+            # Pretty print the response to look for user_id
+            print("\nResponse data:")
+            print(json.dumps(data, indent=2))
+        else:
+            print(f"Failed: {status} - {data}")
         
         # Try a different endpoint - images
         print("\n2. Trying to list images...")
-        nonce = str(int(time.time()))
-        headers[NONCE_HEADER] = nonce
-        sig_str = get_signing_message(HOTKEY_SS58, nonce, payload_str=None, purpose="images")
-        headers[SIGNATURE_HEADER] = keypair.sign(sig_str.encode()).hex()
-        
-        async with session.get("/images/", headers=headers, params={"limit": "1"}) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print("Success!")
-                print(json.dumps(data, indent=2))
-            else:
-                print(f"Failed: {resp.status}")
+        status, _, data = images
+        if status == 200:
+            print("Success!")
+            print(json.dumps(data, indent=2))
+        else:
+            print(f"Failed: {status}")
         
         # Try API keys endpoint
         print("\n3. Trying to list API keys...")
-        nonce = str(int(time.time()))
-        headers[NONCE_HEADER] = nonce
-        sig_str = get_signing_message(HOTKEY_SS58, nonce, payload_str=None, purpose="api_keys")
-        headers[SIGNATURE_HEADER] = keypair.sign(sig_str.encode()).hex()
-        
-        async with session.get("/api_keys/", headers=headers, params={"limit": "1"}) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                print("Success!")
-                print(json.dumps(data, indent=2))
-            else:
-                print(f"Failed: {resp.status}")
+        status, _, data = api_keys
+        if status == 200:
+            print("Success!")
+            print(json.dumps(data, indent=2))
+        else:
+            print(f"Failed: {status}")
 
 if __name__ == "__main__":
     asyncio.run(get_user_info())
@@ -1,40 +1,75 @@
 #!/usr/bin/env python3
 
 import asyncio
-import json
+import random
+import orjson
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.asyncio import tqdm
 from affine.envs.sat import SAT
 
+# Number of problems each worker generates per task
+BATCH_SIZE = 256
+
+# Per-worker SAT environment, created by init_worker
+_sat_env = None
+
+def init_worker():
+    """Create the SAT environment for a worker process."""
+    global _sat_env
+    random.seed()  # Forked workers would otherwise share the parent's RNG state
+    _sat_env = SAT(n=10, k=3)
+
+async def _generate_challenges(count):
+    return await asyncio.gather(*[_sat_env.generate() for _ in range(count)])
+
+def generate_batch(count):
+    """Generate a batch of SAT challenges in a worker, returned as plain dicts."""
+    batch = []
+    for challenge in asyncio.run(_generate_challenges(count)):
+        extra = challenge.extra
+        batch.append({"prompt": challenge.prompt, "solution": extra["sol"], "clauses": extra["cls"]})
+    return batch
+
 async def generate_sat_problems(num_problems=10000):
     """Generate SAT problems and save to JSONL file."""
     sat_env = SAT(n=10, k=3)  # 3-SAT with 10 variables, m defaults to int(4.26 * n)
-    
-    problems = []
-    
-    print(f"Generating {num_problems} SAT problems...")
-    
-    for i in tqdm(range(num_problems), desc="Generating problems"):
-        challenge = await sat_env.generate()
-        
-        problem_data = {
-            "id": i + 1,
-            "prompt": challenge.prompt,
-            "solution": challenge.extra["sol"],
-            "clauses": challenge.extra["cls"],
-            "n_variables": sat_env.n,
-            "k_sat": sat_env.k,
-            "n_clauses": sat_env.m,
-            "formula": challenge.prompt.split('\n')[1]  # Extract the formula from the prompt
-        }
-        
-        problems.append(problem_data)
-    
-    # Save to JSONL file
+
     output_file = "sat_problems_10k.jsonl"
-    with open(output_file, 'w') as f:
-        for problem in problems:
-            f.write(json.dumps(problem, ensure_ascii=False) + '\n')
-    
+    problem_id = 0
+    n_variables, k_sat, n_clauses = sat_env.n, sat_env.k, sat_env.m
+
+    print(f"Generating {num_problems} SAT problems...")
+
+    # SAT generation is pure CPU work, so spread batches across processes
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(initializer=init_worker) as pool, \
+            open(output_file, 'wb', buffering=1 << 20) as f:
+        batches = [
+            loop.run_in_executor(pool, generate_batch, min(BATCH_SIZE, num_problems - start))
+            for start in range(0, num_problems, BATCH_SIZE)
+        ]
+
+        # Stream each batch to the JSONL file as soon as it completes
+        with tqdm(total=num_problems, desc="Generating problems") as pbar:
+            for batch in batches:
+                challenges = await batch
+                for challenge in challenges:
+                    problem_id += 1
+                    prompt = challenge["prompt"]
+                    problem_data = {
+                        "id": problem_id,
+                        "prompt": prompt,
+                        "solution": challenge["solution"],
+                        "clauses": challenge["clauses"],
+                        "n_variables": n_variables,
+                        "k_sat": k_sat,
+                        "n_clauses": n_clauses,
+                        "formula": prompt.split('\n', 2)[1]  # Extract the formula from the prompt
+                    }
+
+                    f.write(orjson.dumps(problem_data, option=orjson.OPT_NON_STR_KEYS) + b'\n')
+                pbar.update(len(challenges))
+
     print(f"Successfully saved {num_problems} SAT problems to {output_file}")
 
 if __name__ == "__main__":
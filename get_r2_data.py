@@ -21,11 +21,14 @@ import affine as af
 import os
 import asyncio
 import json
+import orjson
+import aiofiles
 from dotenv import load_dotenv
 from botocore.config import Config
 from aiobotocore.session import get_session
 from pathlib import Path
-from asyncio import Semaphore
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from tqdm.asyncio import tqdm as async_tqdm
 from tqdm import tqdm
 import time
@@ -34,115 +37,124 @@ import argparse
 # Load environment variables from .env file
 load_dotenv()
 
-# Limit concurrent downloads to avoid overwhelming the server
-MAX_CONCURRENT_DOWNLOADS = 1000
+# Limit concurrent downloads to avoid overwhelming the server.
+# The S3 connection pool is sized to match so downloads never wait on a socket.
+MAX_CONCURRENT_DOWNLOADS = 1024
+
+# Approximate size of the byte range each filter worker processes
+FILTER_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Output row of filter_data, filled in with the individually serialized fields
+FILTERED_ROW = (b'{"uid":%b,"env":%b,"prompt":%b,"response":%b,"model":%b,'
+                b'"score":%d,"evaluation_extra_json":%b}\n')
 
 # Guaranteed keys that must exist in a valid result
 REQUIRED_KEYS = ['version', 'miner', 'challenge', 'response', 'evaluation']
+REQUIRED_KEYS_SET = frozenset(REQUIRED_KEYS)
+
+_MISSING = object()
+
+def loads_json(content):
+    """
+    Parse JSON with orjson, falling back to json for the NaN and Infinity
+    tokens that json.dumps writes and orjson rejects.
+    """
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return json.loads(content)
 
 def normalize_result(item):
     """
     Normalize a result item to have consistent schema by converting 
-    variable-structure fields to JSON strings
+    variable-structure fields to JSON strings.
+    The item is modified in place; callers pass a freshly parsed object.
     """
-    # Create a deep copy to avoid modifying original
-    normalized = json.loads(json.dumps(item))
-    
     # Convert challenge.extra to JSON string if it exists
-    if 'challenge' in normalized and 'extra' in normalized['challenge']:
-        normalized['challenge']['extra_json'] = json.dumps(normalized['challenge']['extra'])
-        del normalized['challenge']['extra']
+    challenge = item.get('challenge')
+    if isinstance(challenge, dict):
+        extra = challenge.pop('extra', _MISSING)
+        if extra is not _MISSING:
+            challenge['extra_json'] = orjson.dumps(extra).decode()
     
-    # Convert evaluation.extra to JSON string if it exists and is not empty
-    if ('evaluation' in normalized and 'extra' in normalized['evaluation'] and 
-        normalized['evaluation']['extra'] and normalized['evaluation']['extra'] != {}):
-        normalized['evaluation']['extra_json'] = json.dumps(normalized['evaluation']['extra'])
-        del normalized['evaluation']['extra']
-    elif 'evaluation' in normalized and 'extra' in normalized['evaluation']:
-        # Remove empty extra field without creating extra_json
-        del normalized['evaluation']['extra']
+    # Convert evaluation.extra to JSON string if it exists and is not empty,
+    # otherwise remove the empty extra field without creating extra_json
+    evaluation = item.get('evaluation')
+    if isinstance(evaluation, dict):
+        extra = evaluation.pop('extra', _MISSING)
+        if extra is not _MISSING and extra:
+            evaluation['extra_json'] = orjson.dumps(extra).decode()
     
     # Convert miner.chute to JSON string if it exists
-    if 'miner' in normalized and 'chute' in normalized['miner'] and normalized['miner']['chute'] is not None:
-        normalized['miner']['chute_json'] = json.dumps(normalized['miner']['chute'])
-        del normalized['miner']['chute']
+    miner = item.get('miner')
+    if isinstance(miner, dict) and miner.get('chute') is not None:
+        miner['chute_json'] = orjson.dumps(miner.pop('chute')).decode()
     
-    return normalized
+    return item
 
-def is_valid_result(json_data):
-    """Check if the JSON data contains a valid result with required keys"""
-    if isinstance(json_data, list):
-        # Check if at least one item in the list has all required keys
-        for item in json_data:
-            if isinstance(item, dict) and all(key in item for key in REQUIRED_KEYS):
-                return True
-        return False
-    elif isinstance(json_data, dict):
-        # Check if the single object has all required keys
-        return all(key in json_data for key in REQUIRED_KEYS)
-    return False
-
-async def process_file(client, key, semaphore):
-    """Process a single file with semaphore for concurrency control"""
-    async with semaphore:
-        try:
-            response = await client.get_object(Bucket=os.getenv("R2_BUCKET_ID"), Key=key)
-            body = response['Body']
-            content = await body.read()
-            
-            # Check if content is empty or just contains []
-            content_str = content.decode('utf-8').strip()
-            if content_str == '[]' or content_str == '':
-                return None, f"Empty file: {key}"
-            
-            # Parse JSON content
-            try:
-                json_data = json.loads(content_str)
-                
-                # Check if the result contains required keys
-                if not is_valid_result(json_data):
-                    return None, f"Invalid result (missing keys): {key}"
-                
-                # Collect normalized items
-                normalized_items = []
-                if isinstance(json_data, list):
-                    for item in json_data:
-                        if isinstance(item, dict) and all(key in item for key in REQUIRED_KEYS):
-                            # Validate score - must be exactly 0 or 1
-                            score = item.get('evaluation', {}).get('score')
-                            # Convert score to int if it's a valid numeric value
-                            if isinstance(score, (int, float)) and score in [0, 1]:
-                                score = int(score)
-                                item['evaluation']['score'] = score
-                            else:
-                                continue  # Skip items with invalid score values
-                            normalized_items.append(normalize_result(item))
+def parse_and_normalize(content, key):
+    """Parse the body of a result file and normalize its valid items"""
+    # Check if content is empty or just contains []
+    content = content.strip()
+    if content == b'[]' or content == b'':
+        return None, f"Empty file: {key}"
+    
+    # Parse JSON content
+    try:
+        json_data = loads_json(content)
+        
+        # Collect normalized items, checking required keys along the way
+        normalized_items = []
+        if isinstance(json_data, list):
+            has_valid_item = False
+            for item in json_data:
+                if not (isinstance(item, dict) and item.keys() >= REQUIRED_KEYS_SET):
+                    continue
+                has_valid_item = True
+                # Validate score - must be exactly 0 or 1
+                score = item.get('evaluation', {}).get('score')
+                # Convert score to int if it's a valid numeric value
+                if isinstance(score, (int, float)) and score in [0, 1]:
+                    score = int(score)
+                    item['evaluation']['score'] = score
                 else:
-                    # If it's a single object
-                    # Validate score - must be exactly 0 or 1
-                    score = json_data.get('evaluation', {}).get('score')
-                    # Convert score to int if it's a valid numeric value
-                    if isinstance(score, (int, float)) and score in [0, 1]:
-                        score = int(score)
-                        json_data['evaluation']['score'] = score
-                    else:
-                        return None, f"Invalid score value ({score}) in {key}"
-                    normalized_items.append(normalize_result(json_data))
-                
-                return normalized_items, None
-                
-            except json.JSONDecodeError as e:
-                return None, f"JSON decode error in {key}: {e}"
-                
-        except Exception as e:
-            return None, f"Error processing {key}: {e}"
+                    continue  # Skip items with invalid score values
+                normalize_result(item)
+                normalized_items.append(item)
+            if not has_valid_item:
+                return None, f"Invalid result (missing keys): {key}"
+        elif not (isinstance(json_data, dict) and json_data.keys() >= REQUIRED_KEYS_SET):
+            return None, f"Invalid result (missing keys): {key}"
+        else:
+            # If it's a single object
+            # Validate score - must be exactly 0 or 1
+            score = json_data.get('evaluation', {}).get('score')
+            # Convert score to int if it's a valid numeric value
+            if isinstance(score, (int, float)) and score in [0, 1]:
+                score = int(score)
+                json_data['evaluation']['score'] = score
+            else:
+                return None, f"Invalid score value ({score}) in {key}"
+            normalize_result(json_data)
+            normalized_items.append(json_data)
+        
+        return normalized_items, None
+        
+    except json.JSONDecodeError as e:
+        return None, f"JSON decode error in {key}: {e}"
 
-async def write_batch(output_file, batch, file_lock):
-    """Write a batch of items to file"""
-    async with file_lock:
-        with open(output_file, 'a', encoding='utf-8') as f:
-            for item in batch:
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+async def process_file(client, key):
+    """Download a single result file and parse it in a worker thread"""
+    try:
+        response = await client.get_object(Bucket=os.getenv("R2_BUCKET_ID"), Key=key)
+        body = response['Body']
+        content = await body.read()
+        
+        # Keep parsing and normalization off the event loop so downloads keep flowing
+        return await asyncio.to_thread(parse_and_normalize, content, key)
+            
+    except Exception as e:
+        return None, f"Error processing {key}: {e}"
 
 async def main():
     start_time = time.time()
@@ -166,67 +178,98 @@ async def main():
         aws_access_key_id=os.getenv("R2_WRITE_ACCESS_KEY_ID"),
         aws_secret_access_key=os.getenv("R2_WRITE_SECRET_ACCESS_KEY"),
         region_name="auto",
-        config=Config(max_pool_connections=256)
+        config=Config(max_pool_connections=MAX_CONCURRENT_DOWNLOADS, tcp_keepalive=True)
     )
     
-    # Create semaphore to limit concurrent downloads
-    semaphore = Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    # Parsing runs in the default executor, give it room for many files at once
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4))
     
-    # Create a single lock for file writing
-    file_lock = asyncio.Lock()
+    # Keys waiting to be downloaded, and normalized batches waiting to be written
+    key_queue = asyncio.Queue()
+    write_queue = asyncio.Queue(maxsize=32)
     
-    print("Fetching file list from R2...")
+    print("Listing and processing files from R2...")
     async with get_client_ctx() as client:
-        paginator = client.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=os.getenv("R2_BUCKET_ID"), Prefix="affine/results/")
-        
-        # Collect all JSON files first
-        json_files = []
-        async for page in pages:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    key = obj['Key']
-                    if key.endswith('.json'):
-                        json_files.append(key)
-        
-        print(f"Found {len(json_files)} JSON files to process")
+        # Warm up the connection (DNS, TLS) before listing and downloading. This
+        # is only a warm-up, credentials that cannot HEAD the bucket still list
+        try:
+            await client.head_bucket(Bucket=os.getenv("R2_BUCKET_ID"))
+        except Exception:
+            pass
         
-        # Process files in batches for better performance
-        batch_size = 100
-        write_batch_size = 1000
-        write_buffer = []
         processed_count = 0
         error_count = 0
         errors = []
+        pbar = async_tqdm(desc="Processing files", unit="file")
         
-        # Process files with progress bar
-        for i in async_tqdm(range(0, len(json_files), batch_size), desc="Processing batches"):
-            batch_files = json_files[i:i + batch_size]
+        async def list_keys():
+            # Feed keys to the download workers as each page arrives
+            paginator = client.get_paginator("list_objects_v2")
+            pages = paginator.paginate(Bucket=os.getenv("R2_BUCKET_ID"), Prefix="affine/results/")
             
-            # Create tasks for this batch
-            tasks = [process_file(client, key, semaphore) for key in batch_files]
+            file_count = 0
+            async for page in pages:
+                if 'Contents' in page:
+                    for obj in page['Contents']:
+                        key = obj['Key']
+                        if key.endswith('.json'):
+                            await key_queue.put((file_count, key))
+                            file_count += 1
             
-            # Process batch
-            results = await asyncio.gather(*tasks)
+            pbar.write(f"Found {file_count} JSON files to process")
+            pbar.total = file_count
+            pbar.refresh()
             
-            # Collect results
-            for items, error in results:
+            # One sentinel per worker signals the end of the listing
+            for _ in range(MAX_CONCURRENT_DOWNLOADS):
+                await key_queue.put(None)
+        
+        async def download_worker():
+            nonlocal processed_count, error_count
+            while (job := await key_queue.get()) is not None:
+                index, key = job
+                items, error = await process_file(client, key)
+                # Every listed file gets a batch, even an empty one, so the writer
+                # knows when the files listed before a batch are all done
+                await write_queue.put((index, items or ()))
                 if items:
-                    write_buffer.extend(items)
                     processed_count += 1
                 else:
                     error_count += 1
                     if error:
                         errors.append(error)
-            
-            # Write buffer when it gets large enough
-            if len(write_buffer) >= write_batch_size:
-                await write_batch(output_file, write_buffer, file_lock)
-                write_buffer = []
+                pbar.update(1)
+        
+        async def writer():
+            # Single writer owns the output file for the whole run, so writes never
+            # interleave and small per-file batches collect in a 1 MiB buffer.
+            # Batches arrive in download-completion order and are held until every
+            # file listed before them is written, so the output keeps listing order.
+            pending = {}
+            next_index = 0
+            async with aiofiles.open(output_file, 'wb', buffering=1 << 20) as f:
+                while (entry := await write_queue.get()) is not None:
+                    # Coalesce whatever else is already queued into one write
+                    pending[entry[0]] = entry[1]
+                    while not write_queue.empty() and (entry := write_queue.get_nowait()) is not None:
+                        pending[entry[0]] = entry[1]
+                    chunks = []
+                    while next_index in pending:
+                        chunks.extend(orjson.dumps(item) + b'\n' for item in pending.pop(next_index))
+                        next_index += 1
+                    if chunks:
+                        await f.write(b''.join(chunks))
+                    if entry is None:
+                        return
         
-        # Write remaining items
-        if write_buffer:
-            await write_batch(output_file, write_buffer, file_lock)
+        async def download_all():
+            workers = [download_worker() for _ in range(MAX_CONCURRENT_DOWNLOADS)]
+            await asyncio.gather(list_keys(), *workers)
+            await write_queue.put(None)
+        
+        await asyncio.gather(writer(), download_all())
+        pbar.close()
         
         # Print summary
         elapsed_time = time.time() - start_time
@@ -246,10 +289,99 @@ async def main():
         print("  - evaluation.extra → evaluation.extra_json")
         print("  - miner.chute → miner.chute_json")
 
+def filter_chunk(input_file, start, end, filter_uid=None, filter_model=None, filter_score='1'):
+    """
+    Filter the lines in the byte range [start, end) of the normalized data.
+    Runs in a worker process; returns the filtered JSONL bytes and the
+    number of kept rows.
+    """
+    with open(input_file, "rb") as fin:
+        fin.seek(start)
+        lines = fin.read(end - start).split(b"\n")
+    
+    # Substrings a line must contain for its score to match: compact output
+    # from orjson and the spaced output of older json.dumps-written files
+    if filter_score != 'both':
+        score_needles = (b'"score":' + filter_score.encode(), b'"score": ' + filter_score.encode())
+    else:
+        score_needles = None
+    
+    out = []
+    for line in lines:
+        if not line:
+            continue
+        # Cheap prefilter, skips parsing rows whose score cannot match
+        if score_needles and score_needles[0] not in line and score_needles[1] not in line:
+            continue
+        try:
+            row = loads_json(line)
+            evaluation = row.get("evaluation", {})
+            challenge = row.get("challenge", {})
+            response = row.get("response", {})
+            # Extract required fields
+            env = challenge.get("env")
+            prompt = challenge.get("prompt")
+            resp = response.get("response")
+            miner = row.get("miner", {})
+            model = miner.get("model")
+            uid = miner.get("uid")
+            
+            # Get score and extra_json if available
+            score = evaluation.get("score")
+            evaluation_extra_json = evaluation.get("extra_json")
+            
+            # Validate score - must be exactly 0 or 1
+            # Convert score to int if it's a valid numeric value
+            if isinstance(score, (int, float)) and score in [0, 1]:
+                score = int(score)
+            else:
+                continue  # Skip records with invalid score values
+            
+            # Apply filters
+            score_match = (filter_score == 'both' or 
+                         (filter_score == '0' and score == 0) or 
+                         (filter_score == '1' and score == 1))
+            
+            # Filter for required fields and matching criteria
+            if (
+                env is not None and
+                prompt is not None and
+                resp is not None and
+                model is not None and
+                score_match and
+                (filter_uid is None or uid == filter_uid) and
+                (filter_model is None or model == filter_model)
+            ):
+                dumps = orjson.dumps
+                out.append(FILTERED_ROW % (
+                    dumps(uid), dumps(env), dumps(prompt), dumps(resp),
+                    dumps(model), score, dumps(evaluation_extra_json),
+                ))
+        except Exception as e:
+            # Skip malformed lines
+            continue
+    
+    return b"".join(out), len(out)
+
+def split_chunks(input_file, chunk_size):
+    """Split a JSONL file into (start, end) byte ranges aligned to line boundaries"""
+    total_bytes = os.path.getsize(input_file)
+    chunks = []
+    with open(input_file, "rb") as fin:
+        start = 0
+        while start < total_bytes:
+            fin.seek(min(start + chunk_size, total_bytes))
+            fin.readline()  # Advance to the start of the next line
+            end = min(fin.tell(), total_bytes)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
 def filter_data(input_file, output_file, filter_uid=None, filter_model=None, filter_score='1'):
     """
     Filter the normalized data and extract specific fields. 
     Optionally filter by specific UID, model name, or score.
+    Lines are filtered in parallel across processes, output order is preserved.
     """
     # Print filter criteria
     filters = []
@@ -265,66 +397,25 @@ def filter_data(input_file, output_file, filter_uid=None, filter_model=None, fil
     else:
         print("Extracting all data (no score filtering)")
     
-    # First, count the number of lines for progress bar
-    with open(input_file, "r", encoding="utf-8") as fin:
-        total_lines = sum(1 for _ in fin)
+    chunks = split_chunks(input_file, FILTER_CHUNK_SIZE)
     
     filtered_count = 0
-    with open(input_file, "r", encoding="utf-8") as fin, open(output_file, "w", encoding="utf-8") as fout:
-        for line in tqdm(fin, total=total_lines, desc="Filtering"):
-            try:
-                row = json.loads(line)
-                evaluation = row.get("evaluation", {})
-                challenge = row.get("challenge", {})
-                response = row.get("response", {})
-                # Extract required fields
-                env = challenge.get("env")
-                prompt = challenge.get("prompt")
-                resp = response.get("response")
-                miner = row.get("miner", {})
-                model = miner.get("model")
-                uid = miner.get("uid")
-                
-                # Get score and extra_json if available
-                score = evaluation.get("score")
-                evaluation_extra_json = evaluation.get("extra_json")
-                
-                # Validate score - must be exactly 0 or 1
-                # Convert score to int if it's a valid numeric value
-                if isinstance(score, (int, float)) and score in [0, 1]:
-                    score = int(score)
-                else:
-                    continue  # Skip records with invalid score values
-                
-                # Apply filters
-                score_match = (filter_score == 'both' or 
-                             (filter_score == '0' and score == 0) or 
-                             (filter_score == '1' and score == 1))
-                
-                # Filter for required fields and matching criteria
-                if (
-                    env is not None and
-                    prompt is not None and
-                    resp is not None and
-                    model is not None and
-                    score_match and
-                    (filter_uid is None or uid == filter_uid) and
-                    (filter_model is None or model == filter_model)
-                ):
-                    filtered = {
-                        "uid": uid,
-                        "env": env,
-                        "prompt": prompt,
-                        "response": resp,
-                        "model": model,
-                        "score": score,
-                        "evaluation_extra_json": evaluation_extra_json
-                    }
-                    fout.write(json.dumps(filtered, ensure_ascii=False) + "\n")
-                    filtered_count += 1
-            except Exception as e:
-                # Skip malformed lines
-                continue
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, \
+            open(output_file, "wb") as fout, \
+            tqdm(total=os.path.getsize(input_file), unit='B', unit_scale=True, desc="Filtering") as pbar:
+        results = executor.map(
+            filter_chunk,
+            repeat(input_file),
+            [start for start, _ in chunks],
+            [end for _, end in chunks],
+            repeat(filter_uid),
+            repeat(filter_model),
+            repeat(filter_score),
+        )
+        for (start, end), (buf, kept) in zip(chunks, results):
+            fout.write(buf)
+            filtered_count += kept
+            pbar.update(end - start)
     
     print(f"\nNumber of rows in filtered dataset: {filtered_count}")
     print(f"Filtered data saved to: {output_file}")
@@ -3,18 +3,280 @@
 Display miner statistics with limited data processing for faster results
 """
 import asyncio
+import contextlib
+import functools
+import gzip
+import io
+import json
 import os
 import sys
 import argparse
-from collections import defaultdict
-from tabulate import tabulate
-from affine import miners, dataset, ENVS, get_subtensor, NETUID, get_client_ctx, get_conf
-import json
+import aiohttp
+from aiohttp import web
+from affine import miners, dataset, get_subtensor, NETUID, get_client_ctx, get_conf
+import numpy as np
+import orjson
+import re
+import sqlite3
 from pathlib import Path
 
+# Score smoothing factor, same as validator
+ALPHA = 0.9
+
+# Environments shown in the table, in display order
+ENV_ORDER = ("ABD", "SAT", "DED")
+ENV_IDX = {env: i for i, env in enumerate(ENV_ORDER)}
+
+# Only results from this many recent blocks are considered
+RECENT_BLOCKS = 1000
+
+# Result files live under this prefix, named "{block}-{hotkey}.json"
+RESULTS_PREFIX = "affine/results/"
+RESULT_KEY_RE = re.compile(r"(?:^|/)(\d+)-[^/]*\.json$")
+
+# Number of recent result files to process
+MAX_FILES = 20
+
+# Blocks covered by each concurrent listing of recent results
+LIST_SHARD_BLOCKS = 100
+
+# Size of the chunks result files are streamed in
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Limit concurrent R2 fetches to stay within the client's connection pool
+MAX_CONCURRENT_FETCHES = 10
+
+# Local port used by --serve and --remote
+DEFAULT_PORT = 8765
+
+
+@functools.cache
+def results_bucket():
+    """R2 bucket holding the results, looked up once per process"""
+    return get_conf("R2_BUCKET_ID")
+
+
+# Reduced result files are cached here between runs, the version changes
+# whenever reduce_results filters rows differently or the table changes
+CACHE_PATH = Path.home() / ".cache" / "affine" / "results-v3.sqlite"
+
+
+class ResultCache:
+    """
+    SQLite cache of reduced result files, keyed by bucket, object key and ETag.
+    The cache only saves downloads: if it cannot be opened or queried the run
+    carries on without it.
+    """
+    
+    def __init__(self, path=CACHE_PATH):
+        self.db = None
+        self.pending = []
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, block INTEGER, rows BLOB)"
+            )
+        except (OSError, sqlite3.Error) as e:
+            print(f"Result cache unavailable, downloading every file: {e}")
+            self.close()
+    
+    def get(self, key):
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute("SELECT rows FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return orjson.loads(row[0]) if row else None
+    
+    def set(self, key, block, rows):
+        """Queue rows for the next flush"""
+        self.pending.append((key, block, orjson.dumps(rows)))
+    
+    def flush(self, min_block):
+        """Write the queued rows and drop files for blocks before min_block, in one commit"""
+        pending, self.pending = self.pending, []
+        if self.db is None:
+            return
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", pending)
+                self.db.execute("DELETE FROM results WHERE block < ?", (min_block,))
+        except sqlite3.Error as e:
+            print(f"Could not update the result cache: {e}")
+    
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def reduce_results(data):
+    """Reduce a result file to (uid, env, score, success) rows from affine models"""
+    rows = []
+    for item in data:
+        try:
+            result = {
+                "miner": item["miner"],
+                "challenge": item["challenge"],
+                "response": item["response"],
+                "evaluation": item["evaluation"]
+            }
+            
+            uid = result["miner"]["uid"]
+            if not isinstance(uid, int):
+                continue
+            
+            # Keep models whose name after the first "/" starts with "affine"
+            model = result["miner"].get("model", "")
+            if not model:
+                continue
+            slash = model.find('/')
+            if slash < 0 or model[slash + 1:slash + 7].lower() != 'affine':
+                continue
+            
+            env = result["challenge"]["env"]
+            if not isinstance(env, str):
+                continue
+            score = result["evaluation"]["score"]
+            success = result["response"]["success"]
+            
+            rows.append((uid, env, score, success))
+        except Exception:
+            continue
+    return rows
+
+
+async def list_all_objects(client, bucket, prefix):
+    """List every result object under prefix"""
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    async for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get("Contents", []))
+    return objects
 
-async def get_miner_stats_fast(target_uid=None):
-    """Fetch miner statistics with limited historical data for speed"""
+
+async def list_recent_objects(client, bucket, prefix, min_block, current_block):
+    """List result objects for blocks min_block..current_block with concurrent sharded listings"""
+    # Keys are "{block}-{hotkey}.json", so every block in the window falls under
+    # one of the prefixes "{prefix}{block // 100}". Take the block format from
+    # a real key, zero-padded block numbers need the shards padded to match.
+    resp = await client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)
+    first = resp.get("Contents", [])
+    match = re.match(r"\d+", first[0]["Key"][len(prefix):]) if first else None
+    if not match:
+        return []
+    digits = match.group(0)
+    width = len(digits) if digits.startswith("0") and len(digits) > 2 else 0
+    
+    def shard_prefix(shard):
+        return f"{prefix}{shard:0{width - 2}d}" if width else f"{prefix}{shard}"
+    
+    # The shard prefixes can also match longer block numbers, i.e. blocks far
+    # past current_block that do not exist yet. The caller only checks min_block.
+    shards = range(min_block // LIST_SHARD_BLOCKS, current_block // LIST_SHARD_BLOCKS + 1)
+    listings = await asyncio.gather(*[
+        list_all_objects(client, bucket, shard_prefix(shard)) for shard in shards
+    ])
+    return [obj for objects in listings for obj in objects]
+
+
+def recent_candidates(objects, min_block):
+    """(block, key, etag) for the result objects at or above min_block"""
+    candidates = []
+    for obj in objects:
+        key = obj["Key"]
+        
+        # Extract block number
+        match = RESULT_KEY_RE.search(key)
+        if not match:
+            continue
+            
+        block = int(match.group(1))
+        if block < min_block:
+            continue
+        
+        candidates.append((block, key, obj.get("ETag")))
+    return candidates
+
+
+def ema_by_group(groups, values, n_groups, alpha):
+    """
+    Final value of s = x * (1 - alpha) + s * alpha, starting from 0, over the
+    values of each group in the order given. Returns the EMA and the number of
+    values per group.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    
+    # The EMA of x_0 .. x_{n-1} is sum((1 - alpha) * alpha**(n - 1 - i) * x_i),
+    # so weight each value by how many later values its group has
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(groups)) - starts[sorted_groups]
+    weights = (1 - alpha) * alpha ** (counts[sorted_groups] - 1 - position)
+    ema = np.bincount(sorted_groups, weights=weights * values[order], minlength=n_groups)
+    return ema, counts
+
+
+def parse_results(raw, content_encoding=None):
+    """Decompress a result file if it was stored gzip-encoded, then parse and reduce it"""
+    if content_encoding == "gzip":
+        raw = gzip.decompress(raw)
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # orjson rejects the NaN and Infinity tokens json.dumps writes. Read them
+        # as None, which is also what the cache gives back for non-finite floats
+        data = json.loads(raw, parse_constant=lambda _: None)
+    return reduce_results(data)
+
+
+async def fetch_results(client, cache, bucket, block, key, etag, semaphore):
+    """Return the reduced rows of a result file, downloading it only on a cache miss"""
+    cache_key = f"{bucket}/{key}:{etag}"
+    rows = cache.get(cache_key)
+    if rows is not None:
+        return rows
+    
+    async with semaphore:
+        resp = await client.get_object(Bucket=bucket, Key=key)
+        # Stream into a single buffer rather than having read() join the chunks
+        raw = bytearray()
+        async for chunk in resp["Body"].iter_chunks(chunk_size=BODY_CHUNK_SIZE):
+            raw.extend(chunk)
+    # Parse and reduce in a thread so other downloads keep progressing
+    rows = await asyncio.to_thread(parse_results, raw, resp.get("ContentEncoding"))
+    cache.set(cache_key, block, rows)
+    return rows
+
+
+def format_grid(rows, headers):
+    """Render rows as a grid table, integer columns right-aligned and others left-aligned"""
+    cells = [[str(value) for value in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in cells]) for i, header in enumerate(headers)]
+    numeric = [bool(rows) and all(isinstance(row[i], int) for row in rows) for i in range(len(headers))]
+    
+    def line(values):
+        padded = (v.rjust(w) if num else v.ljust(w) for v, w, num in zip(values, widths, numeric))
+        return "| " + " | ".join(padded) + " |"
+    
+    separator = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+    lines = [separator, line(headers), separator.replace("-", "=")]
+    for row in cells:
+        lines.append(line(row))
+        lines.append(separator)
+    return "\n".join(lines)
+
+
+async def get_miner_stats_fast(target_uid=None, client=None):
+    """
+    Fetch miner statistics with limited historical data for speed.
+    Uses the given R2 client if one is passed, otherwise opens a new one.
+    """
     print("Fetching miner data...")
     
     # Get current miners
@@ -31,131 +293,110 @@ async def get_miner_stats_fast(target_uid=None):
             return
         print(f"Fetching detailed data for UID {target_uid}...")
     
-    # Initialize score tracking
-    ALPHA = 0.9  # Same as validator
-    scores = {uid: defaultdict(float) for uid in miner_map.keys()}
     prev = {}
     
-    print("Fetching recent results (limited to last 1000 blocks for speed)...")
+    print(f"Fetching recent results (limited to last {RECENT_BLOCKS} blocks for speed)...")
     
     # Get current block to limit our search
     sub = await get_subtensor()
     current_block = await sub.get_current_block()
-    min_block = current_block - 1000  # Only last 1000 blocks
+    min_block = current_block - RECENT_BLOCKS
     
     # Directly fetch recent files from R2
-    bucket = get_conf("R2_BUCKET_ID")
-    prefix = "affine/results/"
+    bucket = results_bucket()
     
     processed_count = 0
-    file_count = 0
     
-    async with get_client_ctx() as client:
-        paginator = client.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    async with contextlib.nullcontext(client) if client else get_client_ctx() as client:
+        # Collect the keys of the files to process
+        objects = await list_recent_objects(client, bucket, RESULTS_PREFIX, min_block, current_block)
+        candidates = recent_candidates(objects, min_block)
+        if not candidates:
+            # Keys not laid out the way the sharded listing expects, walk everything
+            print("No recent results in the sharded listing, listing all results")
+            objects = await list_all_objects(client, bucket, RESULTS_PREFIX)
+            candidates = recent_candidates(objects, min_block)
         
-        async for page in pages:
-            for obj in page.get("Contents", []):
-                key = obj["Key"]
-                name = Path(key).name
-                
-                if not name.endswith(".json"):
-                    continue
-                    
-                # Extract block number
-                base = name[:-5]  # strip ".json"
-                parts = base.split("-", 1)
-                if len(parts) != 2 or not parts[0].isdigit():
-                    continue
-                    
-                block = int(parts[0])
-                if block < min_block:
-                    continue
-                
-                file_count += 1
-                if file_count > 20:  # Limit to 20 most recent files
-                    break
-                
-                print(f"Processing file {file_count}/20: {name}")
-                
-                # Fetch and process this file
-                try:
-                    resp = await client.get_object(Bucket=bucket, Key=key)
-                    raw = await resp["Body"].read()
-                    data = json.loads(raw)
-                    
-                    for item in data:
-                        try:
-                            result = {
-                                "miner": item["miner"],
-                                "challenge": item["challenge"],
-                                "response": item["response"],
-                                "evaluation": item["evaluation"]
-                            }
-                            
-                            uid = result["miner"]["uid"]
-                            if uid not in miner_map:
-                                continue
-                            
-                            model = result["miner"].get("model", "")
-                            if not model or model.split('/')[1].lower()[:6] != 'affine':
-                                continue
-                            
-                            env = result["challenge"]["env"]
-                            score = result["evaluation"]["score"]
-                            success = result["response"]["success"]
-                            
-                            # Update score
-                            if success:
-                                scores[uid][env] = score * (1 - ALPHA) + scores[uid][env] * ALPHA
-                                processed_count += 1
-                                
-                                
-                        except Exception:
-                            continue
-                            
-                except Exception as e:
-                    print(f"Error processing {key}: {e}")
-                    continue
-            
-            if file_count > 20:
-                break
+        # Limit to the 20 most recent files, processed oldest first
+        candidates.sort()
+        keys = candidates[-MAX_FILES:]
+        
+        file_count = len(keys)
+        for i, (_, key, _) in enumerate(keys, 1):
+            print(f"Processing file {i}/{MAX_FILES}: {Path(key).name}")
+        
+        # Fetch all files concurrently, one failed file doesn't affect the others.
+        # Results for past blocks never change, so warm runs skip the download.
+        cache = ResultCache()
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+        try:
+            results = await asyncio.gather(
+                *[fetch_results(client, cache, bucket, block, key, etag, semaphore)
+                  for block, key, etag in keys],
+                return_exceptions=True
+            )
+            # Older blocks are outside every later window, so drop them as well
+            cache.flush(min_block)
+        finally:
+            cache.close()
+    
+    # Gather successful results in listing order, the EMA depends on the order of updates
+    groups = []
+    values = []
+    for (_, key, _), rows in zip(keys, results):
+        if isinstance(rows, Exception):
+            print(f"Error processing {key}: {rows}")
+            continue
+        
+        for uid, env, score, success in rows:
+            if uid not in miner_map or not success or not isinstance(score, (int, float)):
+                continue
+            processed_count += 1
+            if env in ENV_IDX:
+                groups.append(uid * len(ENV_ORDER) + ENV_IDX[env])
+                values.append(score)
+    
+    # Scores as a dense (uid, env) matrix holding the EMA of each group
+    n_uids = max(miner_map) + 1
+    ema, _ = ema_by_group(groups, values, n_uids * len(ENV_ORDER), ALPHA)
+    score_mat = ema.reshape(n_uids, len(ENV_ORDER))
     
     print(f"\nProcessed {processed_count} results from {file_count} files")
     
-    # Filter for specific UID if requested
+    # Only display the requested UID, miner_map stays the full ranking universe
     if target_uid is not None:
-        if target_uid not in miner_map:
-            print(f"UID {target_uid} not found")
-            return
-        miner_map = {target_uid: miner_map[target_uid]}
-    
-    # Calculate ranks for each environment (use all miners for ranking, not just filtered ones)
-    all_miners = await miners()  # Get all miners again for proper ranking
-    ranks = {}
-    for env in ENVS:
-        # Get all miners with scores for this environment for proper ranking
-        env_miners = [(uid, scores[uid][env]) for uid in all_miners.keys() if scores[uid][env] > 0]
-        env_miners.sort(key=lambda x: x[1], reverse=True)
-        
-        # Assign ranks
-        for rank, (uid, _) in enumerate(env_miners, 1):
-            if env not in ranks:
-                ranks[env] = {}
-            ranks[env][uid] = rank
-    
-    # Build table data - reorder to ABD, SAT, DED
-    env_order = ["ABD", "SAT", "DED"]
-    headers = ["UID", "Model"] + [f"{e} Score" for e in env_order] + [f"{e} Rank" for e in env_order]
+        display_map = {target_uid: miner_map[target_uid]}
+    else:
+        display_map = miner_map
+    
+    # Calculate ranks for each environment over all miners, not just displayed ones.
+    # Columns are ranked by descending score and tied miners share the best rank
+    # (rankdata's "min" method). Miners without a score get -1.
+    mask = score_mat > 0
+    neg = np.where(mask, -score_mat, np.inf)
+    sorted_neg = np.sort(neg, axis=0)
+    rank_mat = np.empty(score_mat.shape, dtype=np.int32)
+    for env_i in range(len(ENV_ORDER)):
+        rank_mat[:, env_i] = np.searchsorted(sorted_neg[:, env_i], neg[:, env_i]) + 1
+    rank_mat[~mask] = -1
+    
+    # Order miners by average rank over the environments they are ranked in
+    # (lower is better), miners without any rank sort last
+    ranked = rank_mat > 0
+    n_ranked = ranked.sum(axis=1)
+    avg_rank = np.where(ranked, rank_mat, 0).sum(axis=1) / np.maximum(n_ranked, 1)
+    avg_rank[n_ranked == 0] = np.inf
+    
+    # Build table data
+    headers = ["UID", "Model"] + [f"{e} Score" for e in ENV_ORDER] + [f"{e} Rank" for e in ENV_ORDER]
     rows = []
     
-    for uid, miner in sorted(miner_map.items()):
-        if not miner.model:
+    for uid in np.argsort(avg_rank, kind="stable").tolist():
+        # Only miners with at least one score are shown
+        if not n_ranked[uid]:
             continue
-        
-        # Check if we have any scores for this miner
-        has_scores = any(scores[uid][env] > 0 for env in env_order)
-        if not has_scores:
+        miner = display_map.get(uid)
+        if miner is None or not miner.model:
             continue
             
         row = [
@@ -164,44 +405,82 @@ async def get_miner_stats_fast(target_uid=None):
         ]
         
         # Add scores in ABD, SAT, DED order
-        for env in env_order:
-            score = scores[uid][env]
+        for score in score_mat[uid]:
             row.append(f"{score:.4f}" if score > 0 else "-")
         
         # Add ranks in ABD, SAT, DED order
-        for env in env_order:
-            rank = ranks.get(env, {}).get(uid, "-")
-            row.append(str(rank) if rank != "-" else "-")
+        for rank in rank_mat[uid]:
+            row.append(str(rank) if rank > 0 else "-")
             
         rows.append(row)
     
-    # Sort by average rank (lower is better)
-    def avg_rank(row):
-        rank_values = []
-        for i in range(len(env_order)):
-            rank_str = row[2 + len(env_order) + i]  # Start after UID, Model, and scores
-            if rank_str != "-":
-                rank_values.append(int(rank_str))
-        return sum(rank_values) / len(rank_values) if rank_values else float('inf')
-    
-    rows.sort(key=avg_rank)
-    
     # Display table
     print("\n" + "="*100)
     print("MINER STATISTICS (Recent Data)")
     print("="*100)
-    print(tabulate(rows, headers=headers, tablefmt="grid"))
+    print(format_grid(rows, headers))
     print(f"\nTotal active miners with scores: {len(rows)}")
-    print(f"Environments: {', '.join(env_order)}")
-    print(f"Data source: Last 1000 blocks (~{file_count} files)")
+    print(f"Environments: {', '.join(ENV_ORDER)}")
+    print(f"Data source: Last {RECENT_BLOCKS} blocks (~{file_count} files)")
+
+async def serve(port):
+    """
+    Serve miner statistics at http://127.0.0.1:PORT/stats?uid=UID, keeping the
+    R2 client, subtensor connection and result cache warm between requests
+    """
+    # Reports are captured from stdout, so handle one request at a time
+    lock = asyncio.Lock()
+    
+    async with get_client_ctx() as client:
+        async def handle_stats(request):
+            uid = request.query.get("uid")
+            if uid is not None and not (uid.isascii() and uid.isdigit()):
+                raise web.HTTPBadRequest(text=f"Invalid uid: {uid}")
+            target_uid = int(uid) if uid is not None else None
+            
+            async with lock:
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    await get_miner_stats_fast(target_uid=target_uid, client=client)
+            return web.Response(text=out.getvalue())
+        
+        app = web.Application()
+        app.router.add_get("/stats", handle_stats)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            print(f"Serving miner statistics on http://127.0.0.1:{port}/stats")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+async def fetch_remote(port, target_uid=None):
+    """Print miner statistics from a running --serve process"""
+    params = {"uid": str(target_uid)} if target_uid is not None else {}
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/stats", params=params) as resp:
+            resp.raise_for_status()
+            print(await resp.text(), end="")
 
-async def main():
+def parse_args():
     parser = argparse.ArgumentParser(description="Show miner statistics")
     parser.add_argument("--uid", type=int, help="Show detailed info for specific UID")
-    args = parser.parse_args()
-    
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a long-lived server that keeps connections and caches warm")
+    parser.add_argument("--remote", action="store_true",
+                        help="Fetch statistics from a running --serve process")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port for --serve and --remote (default: {DEFAULT_PORT})")
+    return parser.parse_args()
+
+async def main(args):
     try:
-        await get_miner_stats_fast(target_uid=args.uid)
+        if args.serve:
+            await serve(args.port)
+        elif args.remote:
+            await fetch_remote(args.port, target_uid=args.uid)
+        else:
+            await get_miner_stats_fast(target_uid=args.uid)
     except KeyboardInterrupt:
         print("\nInterrupted by user")
     except Exception as e:
@@ -210,11 +489,13 @@ async def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    # Ensure required environment variables are set
+    args = parse_args()
+    
+    # Ensure required environment variables are set, a --remote client doesn't need them
     required_vars = ["SUBTENSOR_ENDPOINT", "R2_ACCOUNT_ID", "R2_WRITE_ACCESS_KEY_ID", 
                      "R2_WRITE_SECRET_ACCESS_KEY", "R2_BUCKET_ID"]
     
-    missing = [var for var in required_vars if not os.getenv(var)]
+    missing = [var for var in required_vars if not os.getenv(var)] if not args.remote else []
     if missing:
         print("Missing required environment variables:")
         for var in missing:
@@ -222,4 +503,4 @@ if __name__ == "__main__":
         print("\nPlease set these in your .env file or environment")
         exit(1)
     
-    asyncio.run(main())
+    asyncio.run(main(args))